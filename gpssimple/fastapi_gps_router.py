@@ -1,7 +1,9 @@
 # gpssimple/fastapi_gps_router.py
 import os
+import asyncio
+from typing import Optional
 from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse, HTMLResponse
 from .memory_records import add, latest, recent
 
 router = APIRouter()
@@ -26,14 +28,23 @@ async def ingest(request: Request):
 @router.get("/latest")
 async def latest_api():
     it = latest()
-    return JSONResponse(it or {"error": "no data"}, status_code=200 if it else 404)
+    return ORJSONResponse(it or {"error": "no data"}, status_code=200 if it else 404)
 
 @router.get("/recent")
 async def recent_api(limit: int = 100):
-    return JSONResponse(recent(limit))
+    return ORJSONResponse(recent(limit))
+
+_VIEW_HTML_PATH = os.path.join(os.path.dirname(__file__), "templates", "gps_view.html")
+_view_html: Optional[bytes] = None  # 첫 요청 때 1회 읽어 캐시
+
+def _read_view_html() -> bytes:
+    with open(_VIEW_HTML_PATH, "rb") as f:
+        return f.read()
 
 @router.get("/view", include_in_schema=False)
 async def view_page():
-    """분리된 HTML 파일을 반환합니다."""
-    html_path = os.path.join(os.path.dirname(__file__), "templates", "gps_view.html")
-    return FileResponse(html_path, media_type="text/html")
+    """분리된 HTML 파일을 반환합니다. (매 요청 stat/open 없이 메모리 캐시에서)"""
+    global _view_html
+    if _view_html is None:
+        _view_html = await asyncio.to_thread(_read_view_html)
+    return HTMLResponse(_view_html)
@@ -1,42 +1,67 @@
 # gpssimple/memory_records.py
-from threading import RLock
-from datetime import datetime
+import os
+import time
+from collections import deque
+from itertools import islice
 
-_records: list[dict] = []   # 서버 재시작 시 초기화
-_lock = RLock()
+# 고정 크기 링 버퍼: 꽉 차면 가장 오래된 레코드부터 버림 (서버 재시작 시 초기화)
+MAX_RECORDS = int(os.environ.get("GPS_MAX_RECORDS", "100000"))
+# 락 없음: 라우터 핸들러가 모두 async def라 이벤트 루프 스레드에서만 접근함
+_records: deque[dict] = deque(maxlen=MAX_RECORDS)
+
+_ts_cache: tuple[int, str] = (-1, "")
+
+def _received_at() -> str:
+    """수신 시각(UTC, 초 단위 ISO). 같은 초 안에서는 이전에 만든 문자열을 재사용"""
+    global _ts_cache
+    sec = int(time.time())
+    if sec != _ts_cache[0]:
+        _ts_cache = (sec, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(sec)))
+    return _ts_cache[1]
 
 def _f(v):
+    # 선택 필드는 대부분 비어 있으므로 None/float는 예외 처리 없이 바로 반환
+    if v is None:
+        return None
+    if type(v) is float:
+        return v
     try: return float(v)
-    except: return None
+    except (TypeError, ValueError, OverflowError): return None
+
+# 선택 실수 필드: (저장 키, 입력 키 후보) — 앞 후보 값이 비어 있으면 다음 후보 사용
+_FLOAT_FIELDS = (
+    ("speed", ("speed", "spd")),
+    ("accuracy", ("accuracy", "acc")),
+    ("battery", ("battery", "batt", "battery_level")),
+    ("course", ("course", "bearing", "heading")),
+    ("altitude", ("alt", "altitude")),
+)
 
-def add(payload: dict) -> bool:
-    """필수: id, lat, lon"""
-    did = payload.get("id") or payload.get("deviceId") or payload.get("device")
-    lat = _f(payload.get("lat") or payload.get("latitude"))
-    lon = _f(payload.get("lon") or payload.get("lng") or payload.get("longitude"))
+def add(payload: dict, *, _f=_f, _append=_records.append, _now=_received_at,
+        _fields=_FLOAT_FIELDS) -> bool:
+    """필수: id, lat, lon  (키워드 인자는 전역 조회를 줄이기 위한 로컬 바인딩)"""
+    get = payload.get
+    did = get("id") or get("deviceId") or get("device")
+    lat = _f(get("lat") or get("latitude"))
+    lon = _f(get("lon") or get("lng") or get("longitude"))
     if not did or lat is None or lon is None:
         return False
 
-    item = {
-        "device_id": did,
-        "lat": lat, "lon": lon,
-        "speed": _f(payload.get("speed") or payload.get("spd")),
-        "accuracy": _f(payload.get("accuracy") or payload.get("acc")),
-        "battery": _f(payload.get("battery") or payload.get("batt") or payload.get("battery_level")),
-        "course": _f(payload.get("course") or payload.get("bearing") or payload.get("heading")),
-        "altitude": _f(payload.get("alt") or payload.get("altitude")),
-        "timestamp": payload.get("timestamp") or payload.get("time"),
-        "received_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
-    }
-    with _lock:
-        _records.append(item)
+    item = {"device_id": did, "lat": lat, "lon": lon}
+    for dst, keys in _fields:
+        for k in keys:
+            v = get(k)
+            if v:
+                break
+        item[dst] = _f(v)
+    item["timestamp"] = get("timestamp") or get("time")
+    item["received_at"] = _now()
+    _append(item)
     return True
 
 def latest() -> dict | None:
-    with _lock:
-        return _records[-1] if _records else None
+    return _records[-1] if _records else None
 
 def recent(limit: int = 100) -> list[dict]:
     if limit <= 0: limit = 100
-    with _lock:
-        return list(reversed(_records[-limit:]))  # 최신순
+    return list(islice(reversed(_records), limit))  # 최신순
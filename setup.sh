@@ -29,7 +29,7 @@ echo "✅ Setup complete!"
 echo ""
 echo "To start the server, run:"
 echo "  source venv/bin/activate"
-echo "  python server.py"
+echo "  python simpleServer.py"
 echo ""
 echo "Or use the start script:"
 echo "  ./start.sh"
\ No newline at end of file
@@ -1,26 +1,29 @@
 # simpleServer.py
 import os
 import asyncio
+import gzip
+import hashlib
 import logging
+import struct
+import sys
+import time
 from contextlib import asynccontextmanager
+from functools import lru_cache, partial
 from pathlib import Path
 from typing import Tuple, Optional, Callable, Any
 
-from fastapi import FastAPI, WebSocket, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 
+import orjson
+from anyio import EndOfStream, WouldBlock
 from pycrdt_websocket import WebsocketServer
 from pycrdt_websocket.yroom import YRoom
+from pycrdt_websocket.yutils import create_update_message
 from pycrdt import Doc, Text  # 누적 디코딩 및 통계 계산용
 
-#gps server
-# app.py (당신의 기존 FastAPI 엔트리)
 from gpssimple.fastapi_gps_router import router as gps_router
 
-app = FastAPI()
-app.include_router(gps_router, prefix="/gps")   # /gps/ingest, /gps/recent, /gps/latest, /gps/view
-#gps server end
-
 # -------------------------
 # 경로/로깅
 # -------------------------
@@ -36,19 +39,33 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
 )
 logger = logging.getLogger("yws")
-logger.setLevel(logging.DEBUG)  # 디버깅 중엔 DEBUG, 안정화되면 INFO
+# 디버깅 중엔 DEBUG, 안정화되면 YWS_LOG_LEVEL=INFO 이상으로 올려 로그용 디코딩 비용 제거
+logger.setLevel(os.environ.get("YWS_LOG_LEVEL", "DEBUG").upper())
 logger.info("DATA_DIR = %s (Azure: only /home is persisted)", DATA_DIR)
 
 # ✅ 서버 준비 플래그 (로드 끝나기 전 접속 차단용)
 APP_READY = asyncio.Event()
+# 같은 상태의 평범한 bool (접속 핫패스는 이것만 확인; 기동 중 대기만 Event 사용)
+_READY = False
 
-# ✅ 자동 로드 패치 적용 여부
-AUTOLOAD_PATCHED = False
+# 클라이언트 페이지 (lifespan에서 1회 읽어 메모리에 캐시, ETag로 재검증만 하게 함)
+INDEX_HTML: bytes = b""
+INDEX_ETAG: str = ""
+# gzip 사전 압축본 (요청마다 압축하지 않음). 표현이 다르므로 ETag도 따로
+INDEX_HTML_GZ: bytes = b""
+INDEX_ETAG_GZ: str = ""
 
 # -------------------------
 # y-websocket 프레임 요약 파서
 # -------------------------
 def read_varuint(buf: bytes, pos: int) -> Tuple[int, int]:
+    # y-websocket 헤더(type/sub)와 대부분의 길이는 1~2바이트 → 루프 없이 바로 반환
+    b = buf[pos]
+    if b < 0x80:
+        return b, pos + 1
+    b2 = buf[pos + 1]
+    if b2 < 0x80:
+        return (b & 0x7F) | (b2 << 7), pos + 2
     res = 0
     shift = 0
     while True:
@@ -64,34 +81,45 @@ def read_varuint8array(buf: bytes, pos: int) -> Tuple[bytes, int]:
     length, pos = read_varuint(buf, pos)
     return buf[pos:pos + length], pos + length
 
+def read_varuint8len(buf: bytes, pos: int) -> Tuple[int, int]:
+    """read_varuint8array에서 길이만 필요할 때 (본문 슬라이스 복사 없음). 잘린 프레임은 남은 길이까지."""
+    length, pos = read_varuint(buf, pos)
+    return min(length, len(buf) - pos), pos
+
+# 빈 state vector (= Doc().get_state()). 전체 업데이트 인코딩 때마다 Doc을 만들지 않도록 상수로
+_EMPTY_SV = b"\x00"
+# 내용 없는 업데이트. pycrdt는 읽기(get_state/get_update/str 등)도 트랜잭션이라 observe 콜백에 이 값이 옴
+_EMPTY_UPDATE = b"\x00\x00"
+
 SYNC, AWARENESS, AUTH = 0, 1, 2
 SYNC_STEP1, SYNC_STEP2, SYNC_UPDATE = 0, 1, 2
 
 def parse_ws_frame(frame: bytes) -> dict:
     try:
-        pos = 0
-        msg_type, pos = read_varuint(frame, pos)
+        # 알려진 type/sub는 모두 1바이트 varint → 첫 두 바이트로 바로 분기 (본문 길이만 varint 디코딩)
+        # 업데이트 본문만 bytes로 잘라 냄 (pycrdt apply_update가 bytes만 받음), 나머지는 길이만
+        msg_type = frame[0]
         if msg_type == SYNC:
-            sub, pos = read_varuint(frame, pos)
+            sub = frame[1]
             if sub == SYNC_STEP1:
-                sv, pos = read_varuint8array(frame, pos)
-                return {"type": "sync", "sub": "step1", "state_vector_len": len(sv)}
+                sv_len, _ = read_varuint8len(frame, 2)
+                return {"type": "sync", "sub": "step1", "state_vector_len": sv_len}
             elif sub == SYNC_STEP2:
-                upd, pos = read_varuint8array(frame, pos)
+                upd, _ = read_varuint8array(frame, 2)
                 return {"type": "sync", "sub": "step2", "update_len": len(upd), "update": upd}
             elif sub == SYNC_UPDATE:
-                upd, pos = read_varuint8array(frame, pos)
+                upd, _ = read_varuint8array(frame, 2)
                 return {"type": "sync", "sub": "update", "update_len": len(upd), "update": upd}
             else:
-                return {"type": "sync", "sub": f"unknown({sub})"}
+                return {"type": "sync", "sub": f"unknown({read_varuint(frame, 1)[0]})"}
         elif msg_type == AWARENESS:
-            payload, pos = read_varuint8array(frame, pos)
-            return {"type": "awareness", "payload_len": len(payload), "payload_head_hex": payload[:32].hex()}
+            n, pos = read_varuint8len(frame, 1)
+            return {"type": "awareness", "payload_len": n, "payload_head_hex": frame[pos:pos + min(n, 32)].hex()}
         elif msg_type == AUTH:
-            payload, pos = read_varuint8array(frame, pos)
-            return {"type": "auth", "payload_len": len(payload)}
+            n, _ = read_varuint8len(frame, 1)
+            return {"type": "auth", "payload_len": n}
         else:
-            return {"type": f"unknown({msg_type})"}
+            return {"type": f"unknown({read_varuint(frame, 0)[0]})"}
     except Exception as e:
         try:
             head_hex = (bytes(frame)[:32]).hex()
@@ -104,263 +132,752 @@ def parse_ws_frame(frame: bytes) -> dict:
         return {"type": "parse_error", "error": str(e), "head_hex": head_hex, "len": l}
 
 # -------------------------
-# 룸별 디버그 Doc/Text (누적 상태 & delta 확인)
+# 룸별 디버그 Doc/Text (DEBUG 로그의 delta/꼬리 확인 전용)
+# 영속화는 라이브 룸 ydoc 기준 → 디버그 Doc은 DEBUG에서 처음 필요할 때만 만듦
 # -------------------------
-_debug_docs: dict[str, tuple[Doc, Text]] = {}
+# 꼬리 버퍼: [텍스트 전체 길이, 마지막 최대 _TAIL_CAP 바이트] — 델타로 갱신해 로그마다 str(전체) 하지 않음.
+# pycrdt Text의 델타 오프셋/길이는 UTF-8 바이트 단위라 버퍼도 바이트로 유지
+_TAIL_CAP = 1024
+# room -> (Doc, Text, 꼬리 버퍼, delta 수신 리스트)
+_debug_docs: dict[str, tuple[Doc, Text, list, list]] = {}
 
-def _get_debug_ytext(room: str) -> tuple[Doc, Text]:
+def _get_debug_ytext(room: str) -> tuple[Doc, Text, list, list]:
     st = _debug_docs.get(room)
     if st is None:
         d = Doc()
         d["xml"] = Text()
-        _debug_docs[room] = (d, d["xml"])
-    return _debug_docs[room]
+        # 라이브 룸이 있으면 현재 상태로 시작 (이후 수신 업데이트를 delta로 누적)
+        live = ws_server.rooms.get(room)
+        if live is not None:
+            d.apply_update(live.ydoc.get_update(_EMPTY_SV))
+        yxml = d["xml"]
+        # 옵저버는 Doc 생성 시 1번만 등록 → 업데이트마다 observe/unobserve 하지 않음
+        sink: list = []
+        yxml.observe(lambda ev: sink.extend(ev.delta))  # [{'retain':..},{'insert':'..'},{'delete':..}]
+        st = _debug_docs[room] = (d, yxml, _fill_tail(yxml), sink)
+    return st
+
+def _fill_tail(yxml: Text) -> list:
+    b = str(yxml).encode("utf-8")
+    return [len(b), b[-_TAIL_CAP:]]
+
+def _advance_tail(tail: list, delta: list) -> None:
+    """텍스트 delta([{'retain'|'insert'|'delete': ..}])를 꼬리 버퍼에 반영 (O(delta))"""
+    total, buf = tail
+    start = total - len(buf)  # 버퍼가 시작하는 절대 위치
+    pos = 0
+    for op in delta:
+        if "retain" in op:
+            pos += op["retain"]
+        elif "insert" in op:
+            ins = op["insert"]
+            ins = ins.encode("utf-8") if isinstance(ins, str) else b"\xef\xbf\xbc"  # 임베드는 1글자
+            if pos < start:
+                start += len(ins)
+            else:
+                i = pos - start
+                buf = buf[:i] + ins + buf[i:]
+            pos += len(ins)
+            total += len(ins)
+        elif "delete" in op:
+            n = op["delete"]
+            lo, hi = max(pos, start), min(pos + n, total)
+            if hi > lo:
+                buf = buf[:lo - start] + buf[hi - start:]
+            start -= max(0, min(pos + n, start) - pos)
+            total -= n
+    tail[0] = total
+    tail[1] = buf[-_TAIL_CAP:]
 
 def humanize_update_room(room: str, update_bytes: bytes) -> list[dict]:
     """룸별 Doc에 업데이트 누적 적용하면서 delta 반환 (디버그 전용 Doc 사용)"""
-    doc, yxml = _get_debug_ytext(room)
-    deltas: list[dict] = []
-
-    def on_text(ev):
-        deltas.extend(ev.delta)  # [{'retain':..},{'insert':'..'},{'delete':..}]
-
-    yxml.observe(on_text)
-    try:
-        doc.apply_update(update_bytes)
-    finally:
-        try:
-            yxml.unobserve(on_text)
-        except Exception:
-            pass
+    doc, _, tail, sink = _get_debug_ytext(room)
+    sink.clear()
+    doc.apply_update(update_bytes)
+    deltas = sink[:]
+    sink.clear()
+    _advance_tail(tail, deltas)
     return deltas
 
 def get_debug_tail(room: str, n: int = 120) -> str:
-    """현재 누적 상태 꼬리 n글자 (사람 확인용) — 디버그 Doc 기준"""
-    _, yxml = _get_debug_ytext(room)
-    try:
-        s = str(yxml)  # Text.__str__ 트랜잭션으로 안전히 문자열화
-    except Exception:
-        s = ""
+    """현재 누적 상태 꼬리 n글자 (사람 확인용) — 디버그 Doc의 꼬리 버퍼 기준"""
+    _, yxml, tail, _ = _get_debug_ytext(room)
+    # 버퍼 앞부분은 멀티바이트 문자 중간에서 잘렸을 수 있음 → 깨진 바이트는 버림
+    s = tail[1].decode("utf-8", "ignore")
+    if len(s) < n and len(tail[1]) < tail[0]:
+        # 삭제로 버퍼가 n글자 아래로 줄었을 때만 전체 문자열에서 다시 채움
+        try:
+            tail[:] = _fill_tail(yxml)
+        except Exception:
+            return s
+        s = tail[1].decode("utf-8", "ignore")
     return s[-n:]
 
 # -------------------------
 # 간단 영속화: 파일 저장/로드
 # -------------------------
-def _room_to_filename(room: str) -> Path:
+_DATA_DIR_STR = str(DATA_DIR)
+
+@lru_cache(maxsize=4096)
+def _room_paths(room: str) -> Tuple[str, str, str]:
+    """(스냅샷 <room>.bin, 임시 파일, 스냅샷 이후 델타 append 로그 <room>.log) 경로 문자열.
+    저장마다 Path 객체를 만들지 않도록 룸별로 캐시."""
     # 파일 안전화를 위해 슬래시 등을 치환
-    safe = room.replace("/", "__")
-    return DATA_DIR / f"{safe}.bin"
-
-def save_room_snapshot(room: str) -> None:
-    """디버그 Doc의 전체 스냅샷을 파일로 저장 (atomic)"""
-    doc, _ = _get_debug_ytext(room)
-    empty_sv = Doc().get_state()
-    full_update = doc.get_update(empty_sv)
-    tmp = _room_to_filename(room).with_suffix(".bin.tmp")
-    dst = _room_to_filename(room)
+    base = os.path.join(_DATA_DIR_STR, room.replace("/", "__"))
+    return base + ".bin", base + ".bin.tmp", base + ".log"
+
+_LOG_HDR = struct.Struct(">I")  # 레코드 = 4바이트 길이 + 업데이트 바이트
+
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+# 데이터만 디스크에 (mtime 등 메타데이터 flush 생략). fdatasync가 없는 플랫폼은 fsync
+_DATASYNC = getattr(os, "fdatasync", os.fsync)
+
+def _fsync_dir() -> None:
+    """rename/생성한 디렉터리 엔트리를 디스크에 고정 (flush 배치당 1번, 워커 스레드에서 호출).
+    디렉터리를 열 수 없는 플랫폼(Windows 등)은 건너뜀."""
+    try:
+        fd = os.open(_DATA_DIR_STR, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logger.debug("PERSIST dir fsync failed: %s", e)
+    finally:
+        os.close(fd)
+
+def _write_all(fd: int, data: bytes) -> None:
+    # 큰 스냅샷은 한 번에 다 안 써질 수 있음 → memoryview로 남은 부분만 (복사 없이) 이어 씀
+    mv = memoryview(data)
+    while mv:
+        mv = mv[os.write(fd, mv):]
+
+# 로드가 온전하지 않았던 룸 (읽기 실패 / 잘린 로그 레코드 / 적용 실패).
+# 메모리 상태가 디스크 내용 전부가 아닐 수 있으므로 델타 기준점을 잡지 않고,
+# 다음 전체 스냅샷 때 기존 파일을 지우지 않고 <파일>.damaged-<시각>으로 옮겨 보존
+_damaged_rooms: set[str] = set()
+
+def _preserve_damaged_files(room: str) -> None:
+    """손상 룸의 기존 스냅샷/로그를 수동 복구용으로 옮겨 둠 (새 스냅샷 rename 직전, 워커 스레드)."""
+    dst, _, log = _room_paths(room)
+    suffix = ".damaged-%d" % time.time()
+    for path in (dst, log):
+        try:
+            os.replace(path, path + suffix)
+            logger.warning("PERSIST room=%s kept damaged %s as %s", room, path, path + suffix)
+        except FileNotFoundError:
+            pass
+
+def _write_snapshot_file(room: str, data: bytes) -> bool:
+    """tmp에 쓰고 rename (atomic). 블로킹 I/O라 워커 스레드에서 호출. 성공 여부 반환.
+    새 스냅샷이 로그 내용을 모두 포함하므로 로그는 삭제 (컴팩션).
+    rename 후 삭제 전에 죽어도 재시작 시 로그를 한 번 더 적용할 뿐 (CRDT라 멱등).
+    손상 룸이면 기존 파일은 삭제/덮어쓰기 대신 보존."""
+    dst, tmp, log = _room_paths(room)
     try:
-        tmp.write_bytes(full_update)
+        # 버퍼드 파일 객체 없이 fd로 직접 쓰고, rename 전에 fdatasync (크래시 후 빈/잘린 스냅샷 방지).
+        # rename 자체(디렉터리 엔트리)는 flush 배치 끝에 _fsync_dir 한 번으로 고정
+        fd = os.open(tmp, _WRITE_FLAGS, 0o644)
+        try:
+            _write_all(fd, data)
+            _DATASYNC(fd)
+        finally:
+            os.close(fd)
+        if room in _damaged_rooms:
+            _preserve_damaged_files(room)
+            _damaged_rooms.discard(room)
         os.replace(tmp, dst)  # atomic
-        logger.debug("PERSIST room=%s wrote %s bytes -> %s", room, len(full_update), dst.name)
+        try:
+            os.unlink(log)
+        except FileNotFoundError:
+            pass
+        logger.debug("PERSIST room=%s wrote %s bytes -> %s", room, len(data), dst)
+        return True
     except Exception as e:
         logger.warning("PERSIST room=%s failed: %s", room, e)
         try:
-            if tmp.exists():
-                tmp.unlink(missing_ok=True)
-        except Exception:
+            os.unlink(tmp)
+        except OSError:
             pass
+        return False
 
-def load_room_snapshot_bytes(room: str) -> Optional[bytes]:
-    """스냅샷 파일을 읽어서 raw bytes 반환. 없으면 None."""
-    f = _room_to_filename(room)
-    if not f.exists():
-        return None
-    try:
-        return f.read_bytes()
-    except Exception as e:
-        logger.warning("READ room=%s failed: %s", room, e)
-        return None
+# 룸별 마지막으로 디스크에 쓴(또는 읽은) 스냅샷 해시 → 내용이 같으면 쓰기 생략
+_snapshot_hash: dict[str, bytes] = {}
+
+def _snapshot_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+_APPEND_FLAGS = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+# writev는 POSIX 전용 → 없으면 헤더+본문을 이어 붙여 한 번에 씀
+_WRITEV = getattr(os, "writev", None)
 
-def load_room_snapshot_into_memory(room: str) -> bool:
-    """파일이 있으면 디버그 Doc에 적용 (디버그용 상태 누적)."""
-    data = load_room_snapshot_bytes(room)
-    if data is None:
+def _append_log_record(room: str, update: bytes) -> bool:
+    """델타 1건을 로그 끝에 추가 (워커 스레드에서 호출).
+    헤더+본문을 writev 한 번으로 (본문을 헤더 뒤에 복사해 붙이지 않음).
+    실패하면 쓰기 전 길이로 되돌려 로그 중간에 잘린 레코드가 남지 않게 함
+    (되돌리기도 실패하면 False → 호출 측이 기준점을 버려 다음 저장은 전체 스냅샷)."""
+    hdr = _LOG_HDR.pack(len(update))
+    try:
+        fd = os.open(_room_paths(room)[2], _APPEND_FLAGS, 0o644)
+    except OSError as e:
+        logger.warning("PERSIST room=%s log append failed: %s", room, e)
         return False
     try:
-        doc, _ = _get_debug_ytext(room)
-        doc.apply_update(data)
-        tail = get_debug_tail(room, 120)
-        logger.info("LOAD room=%s bytes=%s tail=%r", room, len(data), tail)
+        start = os.fstat(fd).st_size
+        try:
+            if _WRITEV is not None:
+                n = _WRITEV(fd, (hdr, update))
+                if n < len(hdr) + len(update):
+                    # 짧은 쓰기 (디스크 가득 등) → 남은 부분 이어 씀
+                    _write_all(fd, (hdr + update)[n:])
+            else:
+                _write_all(fd, hdr + update)
+        except OSError as e:
+            logger.warning("PERSIST room=%s log append failed: %s; truncating back to %d", room, e, start)
+            os.ftruncate(fd, start)
+            return False
+        logger.debug("PERSIST room=%s appended %s bytes -> log", room, len(update))
         return True
-    except Exception as e:
-        logger.warning("LOAD room=%s failed: %s", room, e)
+    except OSError as e:
+        logger.warning("PERSIST room=%s log append failed: %s", room, e)
+        return False
+    finally:
+        os.close(fd)
+
+# 로그가 스냅샷 크기의 이 배수(단, 최소 SNAPSHOT_LOG_MIN)를 넘으면 전체 스냅샷으로 컴팩션
+SNAPSHOT_LOG_RATIO = 4
+SNAPSHOT_LOG_MIN = 64 * 1024
+
+# 룸별 영속화 기준점: (state vector, 변경 없음 판정용 해시, 스냅샷 바이트, 로그 바이트)
+# 변경 없음 판정: delete만 있는 변경은 state vector가 그대로이므로,
+# 기준점 직후 get_update(sv)(= delete set만 담김)의 해시와 비교
+_persist_base: dict[str, Tuple[bytes, bytes, int, int]] = {}
+
+async def save_room_snapshot(room: str, doc: Doc) -> bool:
+    """룸 Doc(라이브 ydoc) 상태를 파일로 저장.
+    기준점이 있으면 그 이후 델타(get_update(sv))만 <room>.log에 추가하고,
+    처음이거나 로그가 커지면 전체 스냅샷(<room>.bin)으로 다시 씀(로그 삭제).
+    Doc은 스레드 간 이동이 안 되므로 인코딩은 루프에서, 파일 쓰기만 스레드로 넘김.
+    (중복 업데이트 재전송 등으로) 내용이 마지막 저장과 같으면 쓰지 않음.
+    전체 스냅샷을 새로 rename 했으면 True (호출 측이 디렉터리 fsync).
+    로그가 손상된 룸은 그 뒤에 이어 쓰지 않고 전체 스냅샷으로."""
+    base = None if room in _damaged_rooms else _persist_base.get(room)
+    if base is not None:
+        sv, idle_h, snap_n, log_n = base
+        delta = doc.get_update(sv)
+        if _snapshot_digest(delta) == idle_h:
+            logger.debug("PERSIST room=%s unchanged; skip", room)
+            return False
+        rec_n = _LOG_HDR.size + len(delta)
+        if log_n + rec_n <= max(SNAPSHOT_LOG_RATIO * snap_n, SNAPSHOT_LOG_MIN):
+            # 새 기준점은 delta와 같은 시점(await 전)에 잡음 → 쓰는 동안 들어온 편집은 다음 저장의 델타에 포함
+            new_sv = doc.get_state()
+            new_idle_h = _snapshot_digest(doc.get_update(new_sv))
+            if await asyncio.to_thread(_append_log_record, room, delta):
+                _persist_base[room] = (new_sv, new_idle_h, snap_n, log_n + rec_n)
+                _snapshot_hash.pop(room, None)  # 디스크 상태 = 스냅샷 + 로그
+            else:
+                # 로그 끝 상태를 장담할 수 없음 → 기준점을 버려 다음 저장은 전체 스냅샷
+                _persist_base.pop(room, None)
+            return False
+
+    # 전체 스냅샷 (첫 저장 / 컴팩션)
+    # 해시/기준점은 모두 full_update와 같은 시점(await 전)에 잡음 → 쓰는 동안 들어온 편집은 다음 저장에 포함
+    full_update = doc.get_update(_EMPTY_SV)
+    h = _snapshot_digest(full_update)
+    sv = doc.get_state()
+    idle_h = _snapshot_digest(doc.get_update(sv))
+    wrote = False
+    if _snapshot_hash.get(room) == h:
+        logger.debug("PERSIST room=%s unchanged; skip", room)
+    elif await asyncio.to_thread(_write_snapshot_file, room, full_update):
+        _snapshot_hash[room] = h
+        wrote = True
+    else:
         return False
+    _persist_base[room] = (sv, idle_h, len(full_update), 0)
+    return wrote
 
 # -------------------------
-# WebSocket server (라이브 룸 생성 시 자동 로드 패치)
+# 스냅샷 write-back: 변경된 룸만 모아서 디바운스 후 한 번에 저장
 # -------------------------
-ws_server = WebsocketServer()
-
-def precreate_live_room_from_bytes(room: str, update: bytes) -> None:
-    """스냅샷 바이트로 라이브 룸을 미리 만들어 등록."""
-    if room in ws_server.rooms:
-        return
+SNAPSHOT_FLUSH_MS = int(os.environ.get("SNAPSHOT_FLUSH_MS", "500"))
+SNAPSHOT_FLUSH_BYTES = 64 * 1024  # 대기 업데이트가 이만큼 쌓이면 디바운스 없이 바로 저장
+
+# room -> 저장할 Doc. Doc을 직접 잡아 두므로 auto-clean으로 라이브 룸이 먼저 사라져도 저장됨
+_dirty_rooms: dict[str, Doc] = {}
+# room -> 지금 flush가 쓰고 있는 Doc. 파일 쓰기가 끝나기 전엔 디스크에 없으므로 방을 다시 열 때 함께 적용
+_saving_rooms: dict[str, Doc] = {}
+_pending_bytes = 0
+
+def _forget_persist_state(room: str) -> None:
+    """닫힌 룸의 영속화 기준점/해시 해제 (다음 접속 때 디스크에서 다시 잡음).
+    저장 대기/진행 중이면 그 저장이 기준점을 쓰므로 유지 (flush가 끝난 뒤 다시 호출됨)."""
+    if room not in _dirty_rooms and room not in _saving_rooms:
+        _persist_base.pop(room, None)
+        _snapshot_hash.pop(room, None)
+
+_flush_event = asyncio.Event()  # 저장할 룸이 생김
+_flush_now = asyncio.Event()    # 대기 바이트 상한 초과
+_flush_stop = asyncio.Event()   # 종료 요청 (진행 중인 배치는 끝까지 저장한 뒤 루프 종료)
+
+def mark_room_dirty(room: str, doc: Doc, nbytes: int = 0) -> None:
+    """룸을 저장 대상으로 표시 (실제 저장은 snapshot_flusher가 처리)"""
+    global _pending_bytes
+    _dirty_rooms[room] = doc
+    _pending_bytes += nbytes
+    if _pending_bytes >= SNAPSHOT_FLUSH_BYTES:
+        _flush_now.set()
+    _flush_event.set()
+
+async def flush_dirty_rooms() -> None:
+    global _pending_bytes
+    items = list(_dirty_rooms.items())
+    _dirty_rooms.clear()
+    _pending_bytes = 0
+    _saving_rooms.update(items)
+    # 룸끼리는 파일이 달라 겹쳐도 됨 → 인코딩은 루프에서 차례로, 파일 쓰기는 스레드에서 동시에
+    try:
+        results = await asyncio.gather(*(save_room_snapshot(r, d) for r, d in items), return_exceptions=True)
+    finally:
+        for room, doc in items:
+            if _saving_rooms.get(room) is doc:
+                del _saving_rooms[room]
+            if room not in ws_server.rooms:
+                _forget_persist_state(room)  # 저장 중에 닫힌 룸
+    for (room, _), r in zip(items, results):
+        if isinstance(r, Exception):
+            logger.warning("PERSIST room=%s failed: %s", room, r)
+    # 이번 배치에서 rename한 스냅샷이 있으면 디렉터리 fsync는 룸 수와 무관하게 1번
+    if any(r is True for r in results):
+        await asyncio.to_thread(_fsync_dir)
+
+async def snapshot_flusher() -> None:
+    """저장 전담 태스크 (1개). 같은 룸 저장이 겹치지 않도록 여기서만 저장함.
+    종료는 cancel 대신 stop_snapshot_flusher()로 (저장 도중 취소되면 그 배치가 유실됨)."""
+    while not _flush_stop.is_set():
+        await _flush_event.wait()
+        _flush_event.clear()
+        try:
+            await asyncio.wait_for(_flush_now.wait(), SNAPSHOT_FLUSH_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _flush_now.clear()
+        await flush_dirty_rooms()
+
+async def stop_snapshot_flusher(task: asyncio.Task) -> None:
+    """flusher를 깨워 진행/대기 중인 배치를 저장하게 하고 끝날 때까지 기다림"""
+    _flush_stop.set()
+    _flush_now.set()   # 디바운스 대기 생략
+    _flush_event.set()
+    await task
+
+# posix_fadvise는 Linux 등에서만 제공 (Windows/macOS는 일반 읽기)
+_FADVISE = getattr(os, "posix_fadvise", None)
+
+def _read_file(path: str) -> bytes:
+    """파일 전체를 한 번에 읽음 (버퍼드 리더 없이 os.read). 워커 스레드에서 호출.
+    스냅샷/로그는 읽자마자 Doc에 적용하고 버리므로 순차 읽기 + 페이지 캐시 재사용 안 함으로 힌트."""
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
     try:
-        yroom = YRoom()                    # 빈 ydoc 포함
-        yroom.ydoc.apply_update(update)    # 스냅샷 주입
-        ws_server.rooms[room] = yroom      # 키는 WSAdapter.path와 동일해야 함: room
-        logger.info("PRECREATE room=%s bytes=%d", room, len(update))
+        if _FADVISE is not None:
+            # advice 값은 비트 플래그가 아니므로 따로 호출
+            _FADVISE(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            _FADVISE(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+        size = os.fstat(fd).st_size
+        data = os.read(fd, size)
+        if len(data) < size:
+            # 짧은 읽기 (2GB 넘는 파일 등) → 나머지 이어 읽기
+            parts, got = [data], len(data)
+            while got < size:
+                chunk = os.read(fd, size - got)
+                if not chunk:
+                    break
+                parts.append(chunk)
+                got += len(chunk)
+            data = b"".join(parts)
+        return data
+    finally:
+        os.close(fd)
+
+def _unsaved_docs(room: str) -> list:
+    """디스크에 아직 반영되지 않은 룸 Doc들 (저장 대기 + 저장 중)."""
+    docs = []
+    for d in (_dirty_rooms.get(room), _saving_rooms.get(room)):
+        if d is not None and all(d is not x for x in docs):
+            docs.append(d)
+    return docs
+
+def _read_log_records(room: str) -> list:
+    """델타 로그를 레코드 단위로 읽음. 쓰다 만 마지막 레코드(크래시)는 버리고 룸을 손상으로 표시."""
+    try:
+        buf = _read_file(_room_paths(room)[2])
+    except FileNotFoundError:
+        return []
+    out = []
+    pos, end = 0, len(buf)
+    hdr = _LOG_HDR.size
+    while pos + hdr <= end:
+        (n,) = _LOG_HDR.unpack_from(buf, pos)
+        if pos + hdr + n > end:
+            break
+        out.append(buf[pos + hdr:pos + hdr + n])
+        pos += hdr + n
+    if pos != end:
+        logger.warning("READ room=%s log has %d trailing bytes (torn record); ignored", room, end - pos)
+        _damaged_rooms.add(room)
+    return out
+
+def load_room_updates(room: str) -> list:
+    """스냅샷 + 델타 로그를 적용 순서대로 반환 ([snapshot, *deltas]). 스냅샷이 없으면 []."""
+    try:
+        return [_read_file(_room_paths(room)[0]), *_read_log_records(room)]
+    except FileNotFoundError:
+        return []
     except Exception as e:
-        logger.warning("PRECREATE room=%s failed: %s", room, e)
-
-def ensure_live_room_preloaded(room: str) -> bool:
-    """엔드포인트 폴백용: 방이 없으면 스냅샷으로 즉시 생성."""
-    if room in ws_server.rooms:
-        return True
-    data = load_room_snapshot_bytes(room)
-    if not data:
-        return False
-    precreate_live_room_from_bytes(room, data)
-    return True
+        logger.warning("READ room=%s failed: %s", room, e)
+        _damaged_rooms.add(room)
+        return []
 
-import inspect
+# -------------------------
+# WebSocket server (라이브 룸 생성 시 디스크에서 자동 로드)
+# -------------------------
+# 한 번에 꺼내 합칠 최대 업데이트 수
+BROADCAST_MERGE_MAX = 128
 
-def patch_ws_server_autoload() -> bool:
+class FanoutYRoom(YRoom):
     """
-    방 생성 시 디스크 스냅샷을 자동 주입.
-    원본 메서드를 래핑하여(비동기/동기 모두 지원) 새로 만든 방에만 주입.
+    브로드캐스트 fan-out 최적화 YRoom.
+    - 업데이트 메시지는 업데이트당 한 번만 직렬화 (원본은 클라이언트마다 create_update_message)
+    - 클라이언트 목록은 스냅샷(tuple)으로 고정 → 전송 중 접속/해제가 있어도 안전
+    - WSAdapter.send_frame_nowait로 각 클라이언트 송신 큐에 바로 넣음 → 메시지당 태스크 생성/await 없음
+      (실제 전송은 연결별 writer 태스크가 담당, 한 클라이언트의 예외가 룸 태스크그룹을 죽이지 않음)
+    - 버스트 병합: 스트림에 이미 쌓인 업데이트를 한 번에 꺼내, 마지막 전송 시점 state vector 기준
+      diff(ydoc.get_update(sv)) 하나로 합쳐 보냄 (더 작을 때만). 대기 타이머는 두지 않음 → 지연 0
+    - 영속화: ydoc이 실제로 바뀐 업데이트만 스트림에 들어오므로 여기서 저장 대상으로 표시
+      (라이브 ydoc을 그대로 저장 → 별도 디버그 Doc 사본 불필요)
     """
-    global AUTOLOAD_PATCHED
-
-    candidates = [
-        "_get_or_create_room",
-        "get_or_create_room",
-        "get_room",
-        "room",
-    ]
-
-    for name in candidates:
-        orig = getattr(ws_server, name, None)
-        if not callable(orig):
-            continue
 
-        if inspect.iscoroutinefunction(orig):
-            async def patched(self, path, *args, _orig=orig, **kwargs):
-                existed = path in self.rooms
-                room = await _orig(path, *args, **kwargs)   # ✅ await!
-                if not existed:
-                    data = load_room_snapshot_bytes(path)
-                    if data:
-                        try:
-                            room.ydoc.apply_update(data)
-                            logger.info("AUTOLOAD room=%s bytes=%d (async wrapped %s)", path, len(data), _orig.__name__)
-                        except Exception as e:
-                            logger.warning("AUTOLOAD room=%s failed: %s", path, e)
-                    else:
-                        logger.debug("AUTOLOAD room=%s no snapshot; created empty (async %s)", path, _orig.__name__)
-                return room
-        else:
-            def patched(self, path, *args, _orig=orig, **kwargs):
-                existed = path in self.rooms
-                room = _orig(path, *args, **kwargs)         # sync call
-                if not existed:
-                    data = load_room_snapshot_bytes(path)
-                    if data:
+    # 영속화 키 (방 생성 시 FileWebsocketServer.get_room이 설정)
+    name: str = ""
+    # 스트림이 비었을 때(= ydoc 상태가 전부 브로드캐스트된 시점)의 state vector
+    _sent_sv: Optional[bytes] = None
+
+    async def _broadcast_updates(self):
+        if self.ystore is not None and not self.ystore.started.is_set():
+            self._task_group.start_soon(self.ystore.start)
+
+        stream = self._update_receive_stream
+        async with stream:
+            async for update in stream:
+                if self._task_group.cancel_scope.cancel_called:
+                    return
+                batch = [update]
+                drained = False
+                try:
+                    while len(batch) < BROADCAST_MERGE_MAX:
+                        batch.append(stream.receive_nowait())
+                except WouldBlock:
+                    drained = True
+                except EndOfStream:
+                    pass
+                # 읽기 트랜잭션의 빈 업데이트는 보내지 않음. 아래 get_state()도 빈 업데이트를 만들므로
+                # 걸러내지 않으면 클라이언트가 있는 동안 빈 메시지 브로드캐스트가 끝없이 반복됨
+                batch = [u for u in batch if u != _EMPTY_UPDATE]
+                if not batch:
+                    continue
+
+                nbytes = sum(map(len, batch))
+                targets = tuple(self.clients)
+                if targets:
+                    messages = None
+                    if len(batch) > 1 and drained and self._sent_sv is not None:
+                        # 스트림을 다 비웠으므로 ydoc = (_sent_sv 시점 + batch) → diff가 정확히 batch를 담음.
+                        # diff에는 문서 전체 delete set이 붙으므로 실제로 작아질 때만 사용
+                        merged = self.ydoc.get_update(self._sent_sv)
+                        if len(merged) < nbytes:
+                            messages = (create_update_message(merged),)
+                    if messages is None:
+                        messages = tuple(map(create_update_message, batch))
+                    # ASGI send 메시지도 메시지당 1개만 만들어 전원이 공유 (읽기 전용)
+                    frames = [{"type": "websocket.send", "bytes": m} for m in messages]
+                    for c in targets:
                         try:
-                            room.ydoc.apply_update(data)
-                            logger.info("AUTOLOAD room=%s bytes=%d (wrapped %s)", path, len(data), _orig.__name__)
+                            for f in frames:
+                                c.send_frame_nowait(f)
                         except Exception as e:
-                            logger.warning("AUTOLOAD room=%s failed: %s", path, e)
-                    else:
-                        logger.debug("AUTOLOAD room=%s no snapshot; created empty (wrapped %s)", path, _orig.__name__)
-                return room
-
-        setattr(ws_server, name, patched.__get__(ws_server, type(ws_server)))
-        AUTOLOAD_PATCHED = True
-        logger.info("Patched WebsocketServer.%s for autoload (async-aware)", name)
-        break
-
-    if not AUTOLOAD_PATCHED:
-        logger.warning("Autoload patch failed: no matching method; will fallback to endpoint ensure().")
-
-    return AUTOLOAD_PATCHED
+                            self.log.debug("TX update to %s failed: %s", c.path, e)
+                    self._sent_sv = self.ydoc.get_state() if drained else None
+                else:
+                    self._sent_sv = None
+                if self.name:
+                    mark_room_dirty(self.name, self.ydoc, nbytes)
+                if self.ystore:
+                    for u in batch:
+                        self._task_group.start_soon(self.ystore.write, u)
+
+
+class FileWebsocketServer(WebsocketServer):
+    """
+    방 생성 시 디스크 스냅샷(+델타 로그)을 자동 주입하는 WebsocketServer.
+    원본 get_room은 YRoom을 하드코딩 → 새 방은 FanoutYRoom으로 만들어 등록.
+    """
 
-def preload_all_rooms_from_disk() -> None:
+    # 같은 방에 동시 접속 시 start_room이 두 번 불리면 두 번째가 YRoom의 시작 락에서
+    # 영원히 대기함(started가 set 되기 전 경쟁) → 방 시작을 직렬화
+    _room_start_lock = asyncio.Lock()
+
+    async def get_room(self, name: str) -> YRoom:
+        # 이미 시작된 방이면 조회 1번으로 바로 반환 (디스크/락 생략)
+        room = self.rooms.get(name)
+        if room is not None and room.started.is_set():
+            return room
+        if room is None:
+            # 아직 디스크에 없는 변경(저장 대기/진행 중 Doc)은 읽기 전에 잡아 둠
+            # → 읽는 동안 저장이 시작/완료되어도 그 변경을 놓치지 않음 (CRDT라 중복 적용은 무해)
+            pending = _unsaved_docs(name)
+            # 파일 읽기는 스레드에서 (루프 블로킹 방지), Doc 적용은 루프에서
+            updates = await asyncio.to_thread(load_room_updates, name)
+            # 읽는 동안 다른 접속이 같은 방을 먼저 만들었으면 그쪽을 사용
+            room = self.rooms.get(name)
+            if room is None:
+                for d in _unsaved_docs(name):
+                    if all(d is not x for x in pending):
+                        pending.append(d)
+                room = self.rooms[name] = self._create_room(name, updates, pending)
+        async with self._room_start_lock:
+            await self.start_room(room)
+        return room
+
+    async def delete_room(self, *, name: Optional[str] = None, room: Optional[YRoom] = None) -> None:
+        """auto-clean(마지막 클라이언트 퇴장)으로 방이 닫힐 때 룸별 부가 메모리도 함께 해제.
+        저장 안 된 변경은 _dirty_rooms/_saving_rooms가 Doc을 잡고 있으므로 flush에서 저장됨."""
+        if name is None and isinstance(room, FanoutYRoom):
+            name = room.name
+            if self.rooms.get(name) is not room:
+                # 동시에 나간 다른 연결이 이미 지웠음 (원본은 get_room_name에서 ValueError)
+                return
+            room = None
+        await super().delete_room(name=name, room=room)
+        if name is not None:
+            # 디버그 Doc은 방 전체 사본이라 가장 큼 → 다음 DEBUG 접속 때 라이브 룸에서 다시 만듦
+            _debug_docs.pop(name, None)
+            _sizes_cache.pop(name, None)
+            _forget_persist_state(name)
+
+    def _create_room(self, name: str, updates: list, pending: list) -> FanoutYRoom:
+        room = FanoutYRoom(ready=self.rooms_ready, log=self.log)
+        room.name = name
+        # auto-clean으로 닫힌 방의 아직 디스크에 없는 변경 → 디스크 상태 위에 이어 적용
+        for d in pending:
+            updates.append(d.get_update(_EMPTY_SV))
+        if not updates:
+            logger.debug("AUTOLOAD room=%s no snapshot; created empty", name)
+            return room
+        # 하나가 실패해도 나머지(특히 pending)는 계속 적용
+        for u in updates:
+            try:
+                room.ydoc.apply_update(u)
+            except Exception as e:
+                logger.warning("AUTOLOAD room=%s failed: %s", name, e)
+                _damaged_rooms.add(name)
+        if not pending and name not in _persist_base and name not in _damaged_rooms:
+            # 디스크 상태 = 방금 적용한 상태 → 다음 저장은 델타만 로그에 추가
+            # (로드가 온전하지 않았으면 기준점 없이 → 다음 저장은 전체 스냅샷)
+            sv = room.ydoc.get_state()
+            _persist_base[name] = (
+                sv, _snapshot_digest(room.ydoc.get_update(sv)), len(updates[0]),
+                sum(_LOG_HDR.size + len(u) for u in updates[1:]),
+            )
+        logger.info("AUTOLOAD room=%s bytes=%d", name, sum(map(len, updates)))
+        return room
+
+
+ws_server = FileWebsocketServer()
+
+async def compact_room_logs_on_startup() -> None:
     """
-    서버 기동 시: 디버그 Doc에만 누적(사이즈/미리보기용).
-    라이브 룸은 '생성 시 자동 로드' 패치가 처리하므로 여기서 굳이 만들 필요 없음.
+    서버 기동 시: 델타 로그가 남은 룸만 스냅샷+로그를 합쳐 첫 flush에서 전체 스냅샷으로 다시 씀.
+    라이브 룸은 FileWebsocketServer.get_room/_create_room이 생성 시 디스크에서 읽으므로
+    로그가 없는 룸은 접속 전까지 읽지 않음.
+    파일 읽기는 스레드에서 동시에, Doc 적용은 루프에서 (Doc은 스레드 간 이동 불가).
     """
-    for f in DATA_DIR.glob("*.bin"):
-        room = f.stem.replace("__", "/")
+    rooms = [f.stem.replace("__", "/") for f in DATA_DIR.glob("*.log")]
+    results = await asyncio.gather(
+        *(asyncio.to_thread(load_room_updates, room) for room in rooms), return_exceptions=True
+    )
+    for room, updates in zip(rooms, results):
+        if isinstance(updates, BaseException):
+            logger.warning("LOAD room=%s failed: %s", room, updates)
+            continue
+        if not updates:
+            continue
         try:
-            data = f.read_bytes()
-            doc, _ = _get_debug_ytext(room)
-            doc.apply_update(data)
-            tail = get_debug_tail(room, 120)
-            logger.info("LOAD room=%s bytes=%d tail=%r", room, len(data), tail)
+            doc = Doc()
+            for u in updates:
+                doc.apply_update(u)
         except Exception as e:
             logger.warning("LOAD room=%s failed: %s", room, e)
+            _damaged_rooms.add(room)
+        if room in _damaged_rooms:
+            # 일부만 읽힌 상태로 다시 쓰면 나머지를 잃음 → 파일은 그대로 두고 접속 시 처리
+            logger.warning("LOAD room=%s incomplete; not compacting", room)
+            continue
+        mark_room_dirty(room, doc)
+        logger.info("LOAD room=%s bytes=%d records=%d (compacting)", room, sum(map(len, updates)), len(updates))
 
 # -------------------------
 # FastAPI (lifespan)
 # -------------------------
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # 1) 방 생성 시 자동 로드 패치
-    patch_ws_server_autoload()
-    # 2) 디버그 Doc에만 선로딩 (라이브 룸은 생성 시 자동)
-    preload_all_rooms_from_disk()
-    # 3) 서버 시작
+    global INDEX_HTML, INDEX_ETAG, INDEX_HTML_GZ, INDEX_ETAG_GZ, _READY
+    # 0) 클라이언트 페이지 캐시 (요청마다 디스크 읽기 방지)
+    INDEX_HTML = (STATIC_DIR / "simpleClient.html").read_bytes()
+    INDEX_ETAG = '"%s"' % hashlib.blake2b(INDEX_HTML, digest_size=8).hexdigest()
+    INDEX_HTML_GZ = gzip.compress(INDEX_HTML, 9, mtime=0)
+    INDEX_ETAG_GZ = INDEX_ETAG[:-1] + '-gz"'
+    # 1) 남은 델타 로그 컴팩션 예약 (라이브 룸은 생성 시 FileWebsocketServer가 자동 로드)
+    await compact_room_logs_on_startup()
+    # 2) 서버 시작
     task_server = asyncio.create_task(ws_server.start())
+    _flush_stop.clear()
+    task_flusher = asyncio.create_task(snapshot_flusher())
     APP_READY.set()  # ✅ 준비 완료 신호: 이 시점부터 WebSocket 수락
+    _READY = True
     try:
         yield
     finally:
         await ws_server.stop()
         await task_server
+        # 저장 중인 배치는 끝까지 기다리고, 디바운스 대기 중이던 룸까지 저장하고 종료
+        await stop_snapshot_flusher(task_flusher)
+        await flush_dirty_rooms()
+
+# dict를 돌려주는 라우트(/sizes 등)는 orjson으로 직렬화
+app = FastAPI(
+    title="Yjs WebSocket (pycrdt-websocket)",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+app.include_router(gps_router, prefix="/gps")   # /gps/ingest, /gps/recent, /gps/latest, /gps/view
 
-app = FastAPI(title="Yjs WebSocket (pycrdt-websocket)", lifespan=lifespan)
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Accept-Encoding에서 gzip 허용 여부 ("gzip;q=0"은 거부, 명시가 없으면 "*"를 따름)"""
+    star = False
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if coding not in ("gzip", "x-gzip", "*"):
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            k, _, v = param.partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if coding != "*":
+            return q > 0
+        star = q > 0
+    return star
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 목록 중 하나라도 etag와 같으면 True (weak 비교: W/ 무시, "*"는 항상 일치)"""
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
 
 @app.get("/")
-async def root():
-    return FileResponse(STATIC_DIR / "simpleClient.html")
+async def root(request: Request):
+    # 배포마다 내용이 바뀔 수 있어 immutable 대신 no-cache + ETag (변경 없으면 304)
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        body, etag = INDEX_HTML_GZ, INDEX_ETAG_GZ
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding", "Content-Encoding": "gzip"}
+    else:
+        body, etag = INDEX_HTML, INDEX_ETAG
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"})
+    return HTMLResponse(body, headers=headers)
 
 # (선택) 준비 상태 확인용
+# 응답은 준비 여부 두 가지뿐 → 본문을 미리 직렬화해 두고 그대로 반환 (요청마다 dict/직렬화 없음)
+# autoload_patched: 기존 응답 형식 유지 (자동 로드는 FileWebsocketServer에 내장되어 항상 켜짐)
+_READY_BODY = {
+    r: orjson.dumps({"ready": r, "autoload_patched": True}) for r in (False, True)
+}
+
+# async def: 일반 def 라우트는 요청마다 스레드풀로 넘어감 → 플래그만 읽는 헬스체크는 루프에서 바로 처리
 @app.get("/ready")
-def ready():
-    return {"ready": APP_READY.is_set(), "autoload_patched": AUTOLOAD_PATCHED}
+async def ready():
+    return Response(_READY_BODY[_READY], media_type="application/json")
+
+# 라이브 룸별 마지막 /sizes 응답: room -> (상태 키, 응답). 상태가 그대로면 전체 인코딩/문자열화 생략
+_sizes_cache: dict[str, Tuple[Tuple[bytes, bytes], dict]] = {}
 
 @app.get("/sizes/{room}")
 async def sizes(room: str):
     """
-    파일로부터 미리 로드된 디버그 Doc 기준으로 상태 크기/꼬리 반환.
-    (라이브 ydoc은 다른 스레드에서 돌 수 있으므로 직접 접근하지 않음)
+    라이브 룸이 있으면 그 ydoc, 없으면 디스크(스냅샷+로그)를 임시 Doc에 읽어 상태 크기/꼬리 반환.
     """
-    # 혹시라도 디버그 Doc이 아직 비어있으면 1회성 로드 시도
-    _ = load_room_snapshot_into_memory(room)
-
-    doc, yxml = _get_debug_ytext(room)
-    text = str(yxml)  # 안전한 문자열화
-    empty_sv = Doc().get_state()
-    full_update = doc.get_update(empty_sv)
-
-    return {
+    live = ws_server.rooms.get(room)
+    if live is not None:
+        doc = live.ydoc
+        # 상태 키 = state vector + 그 기준 diff(delete set만 담김) → 삭제만 있는 변경도 구분
+        sv = doc.get_state()
+        key = (sv, doc.get_update(sv))
+        hit = _sizes_cache.get(room)
+        if hit is not None and hit[0] == key:
+            return hit[1]
+    else:
+        _sizes_cache.pop(room, None)
+        updates = await asyncio.to_thread(load_room_updates, room)
+        doc = Doc()
+        for u in updates:
+            doc.apply_update(u)
+    text = str(doc.get("xml", type=Text))  # 안전한 문자열화
+    full_update = doc.get_update(_EMPTY_SV)
+
+    res = {
         "room": room,
         "text_chars": len(text),
         "text_utf8_bytes": len(text.encode("utf-8")),
         "bytes_full_update": len(full_update),
         "tail": text[-200:],
     }
+    if live is not None:
+        _sizes_cache[room] = (key, res)
+    return res
 
 # -------------------------
 # Starlette WebSocket -> pycrdt_websocket 어댑터
 # -------------------------
+# 연결당 송신 큐 상한: 못 따라오는 클라이언트 때문에 메모리가 무한히 쌓이지 않도록.
+# CRDT 업데이트는 버리면 안 되므로 넘치면 연결을 끊고(1013) 재접속 시 sync로 따라잡게 함
+WS_SEND_QUEUE_MAX = int(os.environ.get("WS_SEND_QUEUE_MAX", "1024"))
+
+# 프로세스 전체 동시 WebSocket 접속 상한 (넘으면 1013 Try Again Later)
+MAX_WS_CONNECTIONS = int(os.environ.get("MAX_WS_CONNECTIONS", "2000"))
+_ws_active = 0
+
 class WSAdapter:
     """
     send(bytes), recv()->bytes, path, close() 제공
     + async iterator 규약(__aiter__/__anext__)
     + (옵션) parse_fn(frame)->dict, delta_fn(update)->list 로깅
     """
+    # 연결당 1개 → __dict__ 없이 슬롯으로 (메모리 절감 + 속성 접근 가속)
+    __slots__ = (
+        "_send_asgi", "_recv_asgi", "_close_asgi", "_ws",
+        "room", "path", "logger", "log_wire", "log_delta", "parse_fn", "delta_fn", "_debug",
+        "_outq", "_overflowed", "_writer",
+    )
+
     def __init__(
         self,
         ws: WebSocket,
@@ -386,33 +903,84 @@ class WSAdapter:
         self.log_delta = log_delta
         self.parse_fn = parse_fn
         self.delta_fn = delta_fn
+        # 레벨 확인은 연결 시 1회 (메시지마다 isEnabledFor 호출하지 않음; 레벨 변경은 새 연결부터 반영)
+        self._debug = self.logger.isEnabledFor(logging.DEBUG)
+
+        # 송신 큐: pycrdt_websocket은 메시지마다 send 태스크를 띄우므로,
+        # send()는 큐에 넣기만 하고 전용 writer 태스크 하나가 순서대로 내보냄
+        self._outq: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_MAX)
+        self._overflowed = False
+        self._writer = asyncio.create_task(self._drain())
 
     def __aiter__(self):
         return self
 
     async def __anext__(self) -> bytes:
         try:
-            data = await self.recv()
-            return data
-        except Exception:
+            return await self.recv()
+        except WebSocketDisconnect:
             raise StopAsyncIteration
 
     async def send(self, data: Any) -> None:
-        if isinstance(data, memoryview):
-            data = data.tobytes()
-        elif isinstance(data, bytearray):
-            data = bytes(data)
-        elif not isinstance(data, (bytes,)):
-            data = bytes(str(data), "utf-8")
-
-        if self.log_wire and self.parse_fn:
+        self.send_nowait(data)
+
+    def send_nowait(self, data: Any) -> None:
+        """큐에 넣기만 하는 동기 송신 (브로드캐스트 핫패스용: await/태스크 생성 없음)."""
+        # pycrdt_websocket은 항상 bytes를 넘김 → type() 한 번으로 통과 (복사 없음)
+        t = type(data)
+        if t is not bytes:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                data = bytes(data)
+            else:
+                data = str(data).encode("utf-8")
+        self.send_frame_nowait({"type": "websocket.send", "bytes": data})
+
+    def send_frame_nowait(self, frame: dict) -> None:
+        """미리 만든 ASGI send 메시지를 그대로 큐에 넣음.
+        브로드캐스트에서는 같은 dict를 모든 클라이언트가 공유하므로 절대 수정하지 않음."""
+        if self._debug and self.log_wire and self.parse_fn:
+            # TX 파싱은 DEBUG 로그 전용 → DEBUG가 꺼져 있으면 파싱 자체를 생략
+            data = frame["bytes"]
             try:
                 info = self.parse_fn(data)
                 self.logger.debug("TX room=%s %s", self.room, info)
             except Exception as e:
                 self.logger.debug("TX room=%s parse_err=%s len=%s", self.room, e, len(data))
 
-        await self._send_asgi({"type": "websocket.send", "bytes": data})
+        try:
+            self._outq.put_nowait(frame)
+        except asyncio.QueueFull:
+            self._drop_slow_client()
+
+    def _drop_slow_client(self) -> None:
+        if self._overflowed:
+            return
+        self._overflowed = True
+        self.logger.warning(
+            "TX room=%s send queue full (%d); closing slow client code=1013", self.room, WS_SEND_QUEUE_MAX
+        )
+        self._writer.cancel()
+        self._writer = asyncio.create_task(self._close_overflowed())
+
+    async def _close_overflowed(self) -> None:
+        try:
+            await self._send_asgi({"type": "websocket.close", "code": 1013})
+        except Exception:
+            pass
+
+    async def _drain(self) -> None:
+        """송신 큐를 비우는 writer 루프 (연결당 1개).
+        y-websocket 클라이언트는 프레임당 메시지 1개만 해석하므로 합치지 않고 순서대로 보냄.
+        큐에는 ASGI send 메시지(dict)가 들어 있음 → 그대로 전달."""
+        q = self._outq
+        send = self._send_asgi
+        try:
+            while True:
+                await send(await q.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.debug("TX room=%s writer stopped: %s (pending=%d)", self.room, e, q.qsize())
 
     async def recv(self) -> bytes:
         while True:
@@ -422,62 +990,47 @@ class WSAdapter:
             if t == "websocket.receive":
                 b = evt.get("bytes")
                 if b is None:
-                    b = evt.get("text", "").encode("utf-8")
+                    # Yjs 트래픽은 거의 전부 바이너리 → 텍스트 프레임만 인코딩
+                    s = evt.get("text")
+                    b = s.encode("utf-8") if s is not None else b""
 
-                if self.log_wire and self.parse_fn:
+                # 파싱/델타 추출은 DEBUG 로그 전용 (영속화는 룸 브로드캐스트 쪽에서 표시)
+                if self._debug and self.parse_fn:
                     try:
                         info = self.parse_fn(b)
-
-                        if self.log_delta and self.delta_fn and info.get("type") == "sync" \
-                           and info.get("sub") in ("update", "step2") and "update" in info:
-                            # 델타 추출 + 상태 꼬리 로그 (디버그 Doc 기준)
-                            try:
-                                deltas = self.delta_fn(info["update"])
-                                self.logger.info(
-                                    "RX room=%s %s DELTA=%s",
-                                    self.room, f'{info["type"]}/{info["sub"]}', deltas
-                                )
-                                try:
-                                    tail = get_debug_tail(self.room, 120)
-                                    self.logger.info("STATE room=%s tail=%r", self.room, tail)
-                                except Exception:
-                                    pass
-                            except Exception as e:
-                                self.logger.warning(
-                                    "RX room=%s delta_fail=%s ulen=%s",
-                                    self.room, e, info.get("update_len")
-                                )
-
-                            # ✅ 실제 변경이 있을 때만 파일 스냅샷 저장
-                            try:
-                                should_persist = False
-                                if info.get("sub") == "update":
-                                    should_persist = True  # 클라 변경
-                                elif info.get("sub") == "step2":
-                                    # step2라도 유효 바이트 + 델타가 있으면 저장
-                                    should_persist = bool(info.get("update_len", 0) > 0 and deltas)
-
-                                if should_persist:
-                                    save_room_snapshot(self.room)
-                            except Exception as e:
-                                self.logger.debug("PERSIST-SKIP room=%s reason=%s", self.room, e)
-
-                        else:
-                            self.logger.debug("RX room=%s %s", self.room, info)
                     except Exception as e:
                         self.logger.debug("RX room=%s parse_err=%s len=%s", self.room, e, len(b))
+                        return b
+
+                    sub = info.get("sub")
+                    if self.log_delta and self.delta_fn and info.get("type") == "sync" \
+                       and sub in ("update", "step2") and "update" in info:
+                        try:
+                            # 델타 추출 + 상태 꼬리 로그 (디버그 Doc 기준, 처음 필요할 때 생성)
+                            # 델타와 꼬리를 한 줄로 (레코드/핸들러 락 1회)
+                            deltas = self.delta_fn(info["update"])
+                            tail = get_debug_tail(self.room, 120)
+                            self.logger.debug("RX room=%s sync/%s DELTA=%s tail=%r", self.room, sub, deltas, tail)
+                        except Exception as e:
+                            self.logger.debug(
+                                "RX room=%s delta_fail=%s ulen=%s", self.room, e, info.get("update_len")
+                            )
+                    elif self.log_wire:
+                        self.logger.debug("RX room=%s %s", self.room, info)
 
                 return b
 
             if t == "websocket.disconnect":
                 code = evt.get("code")
                 self.logger.info("WS DISCONNECT room=%s code=%s", self.room, code)
-                raise RuntimeError(f"disconnect {code}")
+                raise WebSocketDisconnect(code)
 
             # ping/pong 등은 무시
-            self.logger.debug("WS EVENT room=%s type=%s (ignored)", self.room, t)
+            if self._debug:
+                self.logger.debug("WS EVENT room=%s type=%s (ignored)", self.room, t)
 
     async def close(self) -> None:
+        self._writer.cancel()
         try:
             await self._send_asgi({"type": "websocket.close"})
         except Exception:
@@ -489,7 +1042,7 @@ class WSAdapter:
 @app.websocket("/ws/{room:path}")
 async def ws_endpoint(ws: WebSocket, room: str):
     # 🔐 준비될 때까지는 접속 거절(최대 10초 대기 후 1013)
-    if not APP_READY.is_set():
+    if not _READY:
         try:
             await asyncio.wait_for(APP_READY.wait(), timeout=10)
         except asyncio.TimeoutError:
@@ -497,35 +1050,60 @@ async def ws_endpoint(ws: WebSocket, room: str):
             await ws.close(code=1013)  # Try Again Later
             return
 
-    # # 패치 실패 시에만 폴백 ensure
-    # if not AUTOLOAD_PATCHED:
-    #     if ensure_live_room_preloaded(room):
-    #         logger.debug("ENSURE OK room=%s (fallback before accept)", room)
-    #     else:
-    #         logger.debug("ENSURE SKIP room=%s (no snapshot found; fallback)", room)
-
-    await ws.accept()
-
-    adapter = WSAdapter(
-        ws, room, logger,
-        log_wire=True,
-        log_delta=True,
-        parse_fn=parse_ws_frame,
-        # 룸별 누적 디코딩을 위해 room 캡처 (디버그 Doc 사용)
-        delta_fn=lambda upd, r=room: humanize_update_room(r, upd),
-    )
+    # 🔐 동시 접속 상한: 넘으면 accept 전에 1013으로 거절 (메모리 한도 전에 부하 차단)
+    global _ws_active
+    if _ws_active >= MAX_WS_CONNECTIONS:
+        logger.warning("WS REJECT room=%s code=1013 reason=too many connections (%d)", room, _ws_active)
+        await ws.close(code=1013)
+        return
+    _ws_active += 1
     try:
-        await ws_server.serve(adapter)
-    except Exception as e:
-        logger.exception("serve() aborted room=%s: %s", room, e)
+        await ws.accept()
+        # 같은 방 이름은 같은 str 객체로 → rooms/_dirty_rooms 등 dict 조회가 동일성 비교로 끝남
+        room = sys.intern(room)
+
+        adapter = WSAdapter(
+            ws, room, logger,
+            log_wire=True,
+            log_delta=True,
+            parse_fn=parse_ws_frame,
+            # 룸별 누적 디코딩을 위해 room 고정 (디버그 Doc 사용). partial은 C 구현 → 람다보다 호출이 가벼움
+            delta_fn=partial(humanize_update_room, room),
+        )
+        try:
+            await ws_server.serve(adapter)
+        except Exception as e:
+            logger.exception("serve() aborted room=%s: %s", room, e)
+        finally:
+            await adapter.close()
+            logger.info("WS CLOSE room=%s", room)
     finally:
-        await adapter.close()
-        logger.info("WS CLOSE room=%s", room)
+        _ws_active -= 1
 
 # -------------------------
 # main
 # -------------------------
 if __name__ == "__main__":
+    import importlib.util
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("simpleServer:app", host="0.0.0.0", port=port, log_level=LOG_LEVEL.lower())
+    # uvicorn[standard]의 uvloop/httptools를 명시적으로 사용 (Windows 등 미설치 환경은 기본 구현)
+    # 룸 상태가 프로세스 메모리에 있으므로 워커는 1개 유지
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    # Yjs 업데이트는 압축이 잘 됨 → permessage-deflate 협상 (브라우저가 자동 수락).
+    # CPU가 더 아까운 LAN 환경이면 WS_DEFLATE=0 으로 끔
+    ws_deflate = os.environ.get("WS_DEFLATE", "1") != "0"
+    # 큰 보드의 첫 sync(step2)는 MB 단위 → 한 프레임 상한을 명시 (넘으면 1009로 끊김)
+    ws_max_size = int(os.environ.get("WS_MAX_SIZE", str(16 * 1024 * 1024)))
+    # 종료 시 연결 정리를 기다리는 상한 (uvicorn 기본은 무제한). 안 끝나는 연결이 하나라도 있으면
+    # lifespan 종료(마지막 스냅샷 flush)까지 못 가고, 그 사이 프로세스 매니저가 SIGKILL 하면 편집 유실
+    shutdown_grace = int(os.environ.get("SHUTDOWN_GRACE_S", "10"))
+    uvicorn.run(
+        "simpleServer:app", host="0.0.0.0", port=port,
+        loop=loop, http=http, ws="websockets",
+        ws_per_message_deflate=ws_deflate,
+        ws_max_size=ws_max_size,
+        timeout_graceful_shutdown=shutdown_grace,
+        log_level=LOG_LEVEL.lower(),
+    )